@@ -10,8 +10,10 @@ Gera CSV com 417 municípios da Bahia contendo:
 
 Resumo: 
 Na primeira execução, o script faz requisições para obter dados de fontes externas 
-(API do IBGE, Wikipedia, Nominatim, OSRM) e armazena os resultados em arquivos de cache 
-(geocode.json, route.json, idhm2010.json) dentro do diretório .cache_ba.
+(API do IBGE, Wikipedia, Nominatim, OSRM) e armazena os resultados em cache dentro do
+diretório .cache_ba: geocodificação e rotas em cache.sqlite (mesclado a cada execução com
+geocode.json/route.json, que recebem as entradas novas), municípios e IDHM em
+municipios.json/idhm2010.json.
 
 Nas execuções subsequentes, antes de fazer qualquer requisição, 
 o script verifica se os dados já estão presentes nos arquivos de cache. 
@@ -22,19 +24,19 @@ Fontes:
 - Lista de municípios e códigos IBGE: API IBGE Localidades
   https://servicodados.ibge.gov.br/api/v1/localidades/estados/29/municipios
 - IDHM 2010: Wikipedia - "Lista de municípios da Bahia por IDH-M"
-  (lido via pandas.read_html; se a estrutura mudar, ajuste o seletor de tabela)
+  (lido via lxml/XPath; se a estrutura mudar, ajuste o seletor de tabela)
 - Geocodificação: Nominatim (OpenStreetMap)
 - Roteamento: OSRM público (router.project-osrm.org) = Serviço público gratuito que usa OSRM para cálculos de rota via API.
 
 Requisitos:
 
-  pip install pandas requests beautifulsoup4 tqdm lxml
+  pip install pandas numpy requests tqdm lxml orjson
 
 Uso:
   python ba_417_idh_distancias.py --out distancias_bahia.csv
 
 Dicas:
-- O script usa cache (JSON) para geocodificação e rotas, para evitar repetir chamadas.
+- O script usa cache (SQLite) para geocodificação e rotas, para evitar repetir chamadas.
 - Respeite as políticas de uso de Nominatim/OSRM (delays inseridos).
 
 Observação:
@@ -43,17 +45,28 @@ Observação:
 """
 
 import argparse
+import functools
 import json
-import math
 import os
 import re
+import sqlite3
+import threading
 import time
-from typing import Dict, Optional, Tuple
-from io import StringIO
-
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import lxml.html
+import numpy as np
+import orjson
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 
 # ---------- Configurações ----------
@@ -64,16 +77,53 @@ UF_BA = 29
 API_MUNICIPIOS = f"https://servicodados.ibge.gov.br/api/v1/localidades/estados/{UF_BA}/municipios"
 WIKI_IDHM = "https://pt.wikipedia.org/wiki/Lista_de_munic%C3%ADpios_da_Bahia_por_IDH-M"
 NOMINATIM = "https://nominatim.openstreetmap.org/search"
-
-# Delays para cortesia com os serviços
+OSRM_TABLE = "https://router.project-osrm.org/table/v1/driving"
+
+# Origem fixa: sede da Prefeitura Municipal de Salvador (resultado do Nominatim já usado nas rotas em cache)
+SALVADOR_COORDS = (-12.9741799, -38.512373)
+
+# Sessão HTTP compartilhada: reaproveita conexões TCP/TLS (keep-alive) entre as requisições
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    # Só falhas de conexão são refeitas aqui; as demais tentativas ficam com polite_get,
+    # para que cada uma respeite o intervalo mínimo do host
+    max_retries=Retry(total=3, connect=3, read=False, status=0, other=0, backoff_factor=0.5),
+))
+
+# Tentativas extras de polite_get para respostas 429/5xx e timeouts de leitura
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5  # espera (s) antes da n-ésima nova tentativa após 5xx: HTTP_BACKOFF * 2**n
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Intervalo mínimo (s) entre o início de requisições ao mesmo serviço, por cortesia
 SLEEP_NOMINATIM = 1.5
 SLEEP_OSRM = 0.8
+MIN_INTERVAL_HOST = {
+    urlsplit(NOMINATIM).netloc: SLEEP_NOMINATIM,
+    urlsplit(OSRM_TABLE).netloc: SLEEP_OSRM,
+}
+
+# Requisições simultâneas por serviço: tamanho do executor de cada um em process_municipios
+# (Nominatim: no máximo 1 por vez, pela política de uso)
+CONCURRENCY_NOMINATIM = 1
+CONCURRENCY_OSRM = 4
+
+# Destinos por requisição ao /table da OSRM (mantém a URL abaixo do limite de tamanho)
+OSRM_TABLE_CHUNK = 90
+
+# Quantidade de gravações acumuladas antes de cada commit no cache SQLite
+CACHE_COMMIT_EVERY = 50
 
 # Arquivos de cache
 CACHE_DIR = ".cache_ba"
+CACHE_DB = os.path.join(CACHE_DIR, "cache.sqlite")
 GEOCODE_CACHE = os.path.join(CACHE_DIR, "geocode.json")
 ROUTE_CACHE = os.path.join(CACHE_DIR, "route.json")
 IDHM_CACHE = os.path.join(CACHE_DIR, "idhm2010.json")
+IDHM_META = os.path.join(CACHE_DIR, "idhm2010.meta.json")
 MUNICIPIOS_CACHE = os.path.join(CACHE_DIR, "municipios.json")
 
 # ---------- Utils ----------
@@ -81,36 +131,191 @@ def ensure_cache_dir():
     os.makedirs(CACHE_DIR, exist_ok=True)
 
 def save_json(path: str, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # OPT_INDENT_2 mantém o mesmo layout (UTF-8, 2 espaços) dos caches versionados no repositório
+    Path(path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
 def load_json(path: str) -> Dict:
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+    return orjson.loads(Path(path).read_bytes()) if os.path.exists(path) else {}
+
+# Regexes compiladas uma vez (normalização de nomes e limpeza da tabela de IDHM)
+_RE_WS = re.compile(r"\s+")
+_RE_FOOTNOTE = re.compile(r"\[.*?\]")
+_RE_NONNUM = re.compile(r"[^\d\.]")
 
+@functools.lru_cache(maxsize=4096)
 def normalize_name(name: str) -> str:
-    """Normaliza strings para matching (remove acentos, caixa, espaços extras)."""
-    import unicodedata
+    """Normaliza strings para matching (remove acentos, caixa, espaços extras).
+
+    Memoizada: os nomes de entrada se repetem muito (municípios, cabeçalhos de tabela).
+    """
     s = name.strip().lower()
     s = "".join(c for c in unicodedata.normalize("NFKD", s) if not unicodedata.combining(c))
-    s = re.sub(r"\s+", " ", s)
+    s = _RE_WS.sub(" ", s)
     return s
 
-def haversine_km(lat1, lon1, lat2, lon2) -> float:
-    """Distância geodésica aproximada (haversine) em km."""
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Distância geodésica aproximada (haversine) em km.
+
+    Aceita escalares ou arrays NumPy (vetorizado); coordenadas NaN resultam em NaN.
+    """
     R = 6371.0088  # raio médio da Terra em km
-    phi1 = math.radians(lat1); phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
-    c = 2*math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    phi1 = np.radians(lat1); phi2 = np.radians(lat2)
+    dphi = np.radians(lat2 - lat1)
+    dlambda = np.radians(lon2 - lon1)
+    a = np.sin(dphi/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin(dlambda/2)**2
+    c = 2*np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     return R * c
 
+class CacheDB:
+    """Caches de geocodificação e de rotas em SQLite (modo WAL).
+
+    Cada entrada nova é um INSERT, com commit a cada CACHE_COMMIT_EVERY gravações, em vez de
+    regravar o JSON inteiro. As leituras usam os dicts em memória `geocode` e `route`.
+    geocode.json/route.json (versionados) são mesclados ao abrir, sem sobrescrever o que já
+    está no SQLite; ao fechar, se o SQLite tiver entradas que os JSON não têm, as tabelas são
+    exportadas de volta para esses arquivos.
+    """
+
+    ROUTE_FIELDS = ("distance_km", "duration_h", "origin_name", "origin_coords", "dest_name", "dest_coords")
+
+    def __init__(self, path: str = CACHE_DB):
+        ensure_cache_dir()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, lat REAL, lon REAL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS route (key TEXT PRIMARY KEY, distance_km REAL, duration_h REAL, "
+            "origin_name TEXT, origin_coords TEXT, dest_name TEXT, dest_coords TEXT)"
+        )
+        self._pending = 0
+        self._dirty = False
+        self._import_json()
+
+        self.geocode: Dict[str, list] = {
+            key: [lat, lon] for key, lat, lon in self.conn.execute("SELECT key, lat, lon FROM geocode")
+        }
+        self.route: Dict[str, Optional[Dict]] = {
+            row[0]: self._route_from_row(row[1:]) for row in self.conn.execute("SELECT * FROM route")
+        }
+
+    @classmethod
+    def _route_from_row(cls, row) -> Optional[Dict]:
+        # Linha só com NULLs representa rota não encontrada (None)
+        if all(v is None for v in row):
+            return None
+        return dict(zip(cls.ROUTE_FIELDS, row))
+
+    @classmethod
+    def _route_to_row(cls, info: Optional[Dict]) -> Tuple:
+        return tuple((info or {}).get(f) for f in cls.ROUTE_FIELDS)
+
+    def _import_json(self):
+        """Mescla os caches JSON no SQLite (ex.: entradas novas vindas de um git pull).
+
+        Marca o cache como alterado se o SQLite tiver entradas ausentes dos JSON, para que
+        close() os atualize.
+        """
+        geocode = load_json(GEOCODE_CACHE)
+        route = load_json(ROUTE_CACHE)
+        self.conn.executemany("INSERT OR IGNORE INTO geocode VALUES (?, ?, ?)", [(k, v[0], v[1]) for k, v in geocode.items()])
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO route VALUES (?, ?, ?, ?, ?, ?, ?)", [(k, *self._route_to_row(v)) for k, v in route.items()]
+        )
+        self.conn.commit()
+        n_geocode, = self.conn.execute("SELECT COUNT(*) FROM geocode").fetchone()
+        n_route, = self.conn.execute("SELECT COUNT(*) FROM route").fetchone()
+        self._dirty = n_geocode > len(geocode) or n_route > len(route)
+
+    def put_geocode(self, key: str, coords: Tuple[float, float]):
+        lat, lon = coords
+        self.geocode[key] = [lat, lon]
+        self.conn.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)", (key, lat, lon))
+        self._written()
+
+    def put_route(self, key: str, info: Optional[Dict]):
+        self.route[key] = info
+        self.conn.execute("INSERT OR REPLACE INTO route VALUES (?, ?, ?, ?, ?, ?, ?)", (key, *self._route_to_row(info)))
+        self._written()
+
+    def _written(self):
+        self._dirty = True
+        self._pending += 1
+        if self._pending >= CACHE_COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        if self._dirty:
+            save_json(GEOCODE_CACHE, self.geocode)
+            save_json(ROUTE_CACHE, self.route)
+        self.conn.close()
+
+_host_lock = threading.Lock()
+_host_next_call: Dict[str, float] = {}
+
+def _wait_for_slot(host: str, min_interval: float):
+    """Reserva o próximo horário livre do host e dorme só o necessário até ele."""
+    with _host_lock:
+        now = time.monotonic()
+        start = max(now, _host_next_call.get(host, 0.0))
+        _host_next_call[host] = start + min_interval
+    if start > now:
+        time.sleep(start - now)
+
+def _retry_after_seconds(value: Optional[str], default: float = 5.0) -> float:
+    """Interpreta o cabeçalho Retry-After (segundos ou data HTTP)."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+def _defer_host(host: str, wait: float):
+    """Adia as próximas chamadas ao host por `wait` segundos a partir de agora."""
+    with _host_lock:
+        _host_next_call[host] = max(_host_next_call.get(host, 0.0), time.monotonic() + wait)
+
+def polite_get(url: str, **kwargs) -> requests.Response:
+    """GET pela SESSION respeitando o intervalo mínimo do host, com novas tentativas.
+
+    Em condições normais espera apenas o que falta do intervalo desde a última chamada ao
+    host (e não um delay fixo após cada resposta). Respostas 429/5xx e timeouts de leitura
+    são refeitos até HTTP_RETRIES vezes, cada tentativa passando pelo intervalo do host:
+    em 429/503 as próximas chamadas ao host são adiadas pelo Retry-After; nos demais casos,
+    por um backoff exponencial. Após a última tentativa, devolve a resposta (ou propaga o
+    timeout) como veio.
+    """
+    host = urlsplit(url).netloc
+    min_interval = MIN_INTERVAL_HOST.get(host, 0.0)
+    for attempt in range(HTTP_RETRIES + 1):
+        last = attempt == HTTP_RETRIES
+        _wait_for_slot(host, min_interval)
+        try:
+            r = SESSION.get(url, **kwargs)
+        except requests.ReadTimeout:
+            if last:
+                raise
+            _defer_host(host, HTTP_BACKOFF * 2 ** attempt)
+            continue
+        if last or r.status_code not in RETRY_STATUS:
+            return r
+        if r.status_code in (429, 503):
+            _defer_host(host, _retry_after_seconds(r.headers.get("Retry-After")))
+        else:
+            _defer_host(host, HTTP_BACKOFF * 2 ** attempt)
+
 # ---------- Coleta IBGE ----------
 def get_municipios_ibge() -> pd.DataFrame:
-    """Retorna DataFrame com colunas: municipio, codigo_ibge. Usa cache."""
+    """Retorna DataFrame com colunas: municipio, codigo_ibge, _key (nome normalizado). Usa cache."""
     ensure_cache_dir()
     
     if os.path.exists(MUNICIPIOS_CACHE):
@@ -118,7 +323,7 @@ def get_municipios_ibge() -> pd.DataFrame:
     else:
         print("Cache de municípios não encontrado. Buscando na API do IBGE...")
         try:
-            r = requests.get(API_MUNICIPIOS, headers=HEADERS, timeout=60)
+            r = polite_get(API_MUNICIPIOS, timeout=60)
             r.raise_for_status()
             j = r.json()
             rows = [{"municipio": item["nome"], "codigo_ibge": int(item["id"])} for item in j]
@@ -129,65 +334,142 @@ def get_municipios_ibge() -> pd.DataFrame:
             exit(1)
 
     df = pd.DataFrame(rows)
+    # Chave normalizada, calculada uma vez e reutilizada no restante do pipeline
+    df["_key"] = df["municipio"].map(normalize_name)
     # Ordena alfabeticamente (ignorar acentos/caixa)
-    df["nome_key"] = df["municipio"].map(normalize_name)
-    df = df.sort_values("nome_key").drop(columns=["nome_key"]).reset_index(drop=True)
+    df = df.sort_values("_key").reset_index(drop=True)
     return df
 
 # ---------- IDHM 2010 ----------
-def get_idhm_2010() -> Dict[str, float]:
-    """Retorna dict {nome_normalizado: idhm_2010} usando cache; fonte Wikipedia."""
+def _span(cell, attr: str) -> int:
+    try:
+        return max(1, int(cell.get(attr, 1)))
+    except ValueError:
+        return 1
+
+def _table_grid(table) -> List[Tuple[bool, List[str]]]:
+    """Expande rowspan/colspan de uma <table> lxml em uma grade de textos.
+
+    Retorna uma lista de (linha_so_de_th, celulas), com as células alinhadas por coluna,
+    como pd.read_html faz (ex.: posições empatadas num ranking usam rowspan).
+    """
+    grid = []
+    pending: Dict[int, Tuple[str, int]] = {}  # coluna -> (texto, linhas restantes)
+    for tr in table.xpath(".//tr"):
+        cells = tr.xpath("./th|./td")
+        if not cells:
+            continue
+        row: List[str] = []
+        cells_iter = iter(cells)
+        col = 0
+        while True:
+            if col in pending:
+                text, left = pending.pop(col)
+                if left > 1:
+                    pending[col] = (text, left - 1)
+                row.append(text)
+                col += 1
+                continue
+            cell = next(cells_iter, None)
+            if cell is None:
+                break
+            text = cell.text_content().strip()
+            rowspan = _span(cell, "rowspan")
+            for _ in range(_span(cell, "colspan")):
+                if rowspan > 1:
+                    pending[col] = (text, rowspan - 1)
+                row.append(text)
+                col += 1
+        grid.append((all(c.tag == "th" for c in cells), row))
+    return grid
+
+def parse_idhm_html(content: bytes) -> Dict[str, float]:
+    """Extrai {nome_normalizado: idhm_2010} do HTML da página da Wikipedia."""
+    tree = lxml.html.fromstring(content)
+    # Lê só as tabelas de dados (wikitable) que tenham cabeçalho com "IDH"
+    tables = tree.xpath("//table[contains(@class,'wikitable') and .//th[contains(., 'IDH')]]")
+    idh_map: Dict[str, float] = {}
+    for table in tables:
+        grid = _table_grid(table)
+        # Cabeçalho: todas as linhas iniciais compostas só por <th>
+        n_header = next((k for k, (only_th, _) in enumerate(grid) if not only_th), len(grid))
+        if n_header == 0:
+            continue
+        width = max(len(row) for _, row in grid[:n_header])
+        cols = []
+        for j in range(width):
+            parts = [row[j] for _, row in grid[:n_header] if j < len(row)]
+            cols.append(normalize_name(" ".join(dict.fromkeys(parts))))
+        # Procura a primeira coluna que tenha "munic" e a 1ª coluna com "idh"
+        col_mun = next((j for j, c in enumerate(cols) if "munic" in c), None)
+        col_idh = next((j for j, c in enumerate(cols) if "idh" in c), None)
+        if col_mun is None or col_idh is None:
+            continue
+
+        nomes, idhs = [], []
+        for _, cells in grid[n_header:]:
+            if len(cells) <= max(col_mun, col_idh) or not cells[col_mun] or not cells[col_idh]:
+                continue
+            nomes.append(cells[col_mun])
+            idhs.append(cells[col_idh])
+
+        # Limpeza vetorizada: remove notas/rodapés do nome e converte o IDH ("0,759" -> 0.759)
+        names = pd.Series(nomes, dtype=str).str.replace(_RE_FOOTNOTE, "", regex=True).str.strip()
+        idh = pd.to_numeric(
+            pd.Series(idhs, dtype=str).str.replace(",", ".", regex=False).str.replace(_RE_NONNUM, "", regex=True),
+            errors="coerce",
+        )
+        valid = idh.notna()
+        idh_map.update(zip(names[valid].map(normalize_name), idh[valid].tolist()))
+
+    if not idh_map:
+        raise RuntimeError("Não foi possível extrair tabela de IDHM 2010 do Wikipedia.")
+    return idh_map
+
+def get_idhm_2010(refresh: bool = False) -> Dict[str, float]:
+    """Retorna dict {nome_normalizado: idhm_2010} usando cache; fonte Wikipedia.
+
+    Com `refresh`, revalida o cache com um GET condicional (ETag/Last-Modified):
+    se a página não mudou (304), devolve o cache sem baixar nem reprocessar o HTML.
+    Se a revalidação falhar (requisição ou extração da tabela) e houver cache, ele é
+    devolvido com um aviso.
+    """
     ensure_cache_dir()
     cache = load_json(IDHM_CACHE)
-    if cache:
+    if cache and not refresh:
         return {k: float(v) for k, v in cache.items()}
 
-    # Tenta ler tabelas da página
-    resp = requests.get(WIKI_IDHM, headers=HEADERS, timeout=60)
-    resp.raise_for_status()
-    tables = pd.read_html(StringIO(resp.text))
-    # Encontrar tabela que contenha colunas Município e IDH
-    idh_map: Dict[str, float] = {}
-    found_any = False
-    for tbl in tables:
-        cols = [normalize_name(str(c)) for c in tbl.columns]
-        if any("munic" in c for c in cols) and any("idh" in c for c in cols):
-            # Tenta identificar as colunas
-            try:
-                # Procura a primeira coluna que tenha "munic"
-                col_mun = next(c for c in tbl.columns if "munic" in normalize_name(str(c)))
-            except StopIteration:
-                continue
-            # Procura a 1ª coluna com "idh"
-            try:
-                col_idh = next(c for c in tbl.columns if "idh" in normalize_name(str(c)))
-            except StopIteration:
-                continue
+    headers = {}
+    if cache:
+        meta = load_json(IDHM_META)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
 
-            for _, row in tbl[[col_mun, col_idh]].dropna().iterrows():
-                nome = str(row[col_mun])
-                # limpa notas/rodapés
-                nome = re.sub(r"\[.*?\]", "", nome).strip()
-                idh_txt = str(row[col_idh]).strip().replace(",", ".")
-                try:
-                    idh_val = float(re.sub(r"[^\d\.]", "", idh_txt))
-                except Exception:
-                    continue
-                key = normalize_name(nome)
-                idh_map[key] = idh_val
-            found_any = True
-
-    if not found_any or not idh_map:
-        raise RuntimeError("Não foi possível extrair tabela de IDHM 2010 do Wikipedia.")
+    try:
+        resp = polite_get(WIKI_IDHM, headers=headers, timeout=60)
+        if resp.status_code == 304 and cache:
+            return {k: float(v) for k, v in cache.items()}
+        resp.raise_for_status()
+        idh_map = parse_idhm_html(resp.content)
+    except (requests.RequestException, RuntimeError) as e:
+        if not cache:
+            raise
+        # Sem como revalidar (rede ou layout da página), segue com o cache existente
+        print(f"\nAviso: Falha ao revalidar o IDHM na Wikipedia, usando o cache: {e}")
+        return {k: float(v) for k, v in cache.items()}
 
+    # Só grava cache e metadados depois de uma extração bem-sucedida
     save_json(IDHM_CACHE, idh_map)
+    save_json(IDHM_META, {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")})
     return idh_map
 
 # ---------- Geocodificação ----------
 def geocode(query: str) -> Optional[Tuple[float, float]]:
     """Geocodifica com Nominatim (lat, lon)."""
     params = {"q": query, "format": "jsonv2", "limit": 1, "addressdetails": 0}
-    r = requests.get(NOMINATIM, params=params, headers=HEADERS, timeout=30)
+    r = polite_get(NOMINATIM, params=params, timeout=30)
     r.raise_for_status()
     j = r.json()
     if not j:
@@ -201,7 +483,6 @@ def geocode_municipio(nome: str) -> Optional[Tuple[float, float]]:
     coords = geocode(q1)
     if coords:
         return coords
-    time.sleep(SLEEP_NOMINATIM)
     # 2) Município
     q2 = f"{nome}, Bahia, Brasil"
     coords = geocode(q2)
@@ -219,173 +500,270 @@ def get_salvador_coords() -> Tuple[float, float]:
     return coords
 
 # ---------- OSRM (rota rodoviária) ----------
-def get_osrm_route_info(orig: Tuple[float, float], dest: Tuple[float, float]) -> Optional[Dict]:
-    """Obtém informações de rota (distância, duração, etc.) da API OSRM."""
+def get_osrm_table_info(orig: Tuple[float, float], dests: List[Tuple[float, float]]) -> Optional[List[Optional[Dict]]]:
+    """Obtém informações de rota (distância, duração, etc.) de uma origem para vários destinos.
+
+    Usa o serviço /table da OSRM, que calcula toda a linha da matriz origem -> destinos em
+    uma única requisição. Retorna uma lista alinhada a `dests` (None para destinos sem rota),
+    ou None se a requisição falhar.
+    """
     olat, olon = orig
-    dlat, dlon = dest
-    
-    url = f"https://router.project-osrm.org/route/v1/driving/{olon},{olat};{dlon},{dlat}?overview=false&alternatives=false"
-    
+    coords = ";".join(f"{lon},{lat}" for lat, lon in [(olat, olon), *dests])
+    destinations = ";".join(str(j) for j in range(1, len(dests) + 1))
+
+    url = f"{OSRM_TABLE}/{coords}?sources=0&destinations={destinations}&annotations=distance,duration"
+
     try:
-        r = requests.get(url, headers=HEADERS, timeout=60)
+        r = polite_get(url, timeout=120)
         r.raise_for_status()
-        
+
         data = r.json()
-        
-        if not data.get("routes") or not data.get("waypoints"):
+
+        if data.get("code") != "Ok" or not data.get("sources") or not data.get("destinations"):
             return None
-            
-        route = data["routes"][0]
-        waypoints = data["waypoints"]
-        
-        distance_km = route.get("distance") / 1000.0 if route.get("distance") is not None else None
-        duration_h = route.get("duration") / 3600.0 if route.get("duration") is not None else None
-        
-        origin_wp = waypoints[0]
-        dest_wp = waypoints[1]
-        
+
+        distances = data["distances"][0]
+        durations = data["durations"][0]
+        origin_wp = data["sources"][0]
+
         # OSRM retorna coordenadas como [longitude, latitude], então invertemos para o padrão [lat, lon]
         origin_coords_list = origin_wp.get("location")
         origin_coords = f"{origin_coords_list[1]}, {origin_coords_list[0]}" if origin_coords_list else None
-        
-        dest_coords_list = dest_wp.get("location")
-        dest_coords = f"{dest_coords_list[1]}, {dest_coords_list[0]}" if dest_coords_list else None
-        
-        return {
-            "distance_km": distance_km,
-            "duration_h": duration_h,
-            "origin_name": origin_wp.get("name") or "N/A",
-            "origin_coords": origin_coords,
-            "dest_name": dest_wp.get("name") or "N/A",
-            "dest_coords": dest_coords
-        }
-        
+
+        infos: List[Optional[Dict]] = []
+        for dest_wp, distance, duration in zip(data["destinations"], distances, durations):
+            if distance is None:
+                infos.append(None)
+                continue
+
+            dest_coords_list = dest_wp.get("location")
+            dest_coords = f"{dest_coords_list[1]}, {dest_coords_list[0]}" if dest_coords_list else None
+
+            infos.append({
+                "distance_km": distance / 1000.0,
+                "duration_h": duration / 3600.0 if duration is not None else None,
+                "origin_name": origin_wp.get("name") or "N/A",
+                "origin_coords": origin_coords,
+                "dest_name": dest_wp.get("name") or "N/A",
+                "dest_coords": dest_coords
+            })
+        return infos
+
     except (requests.RequestException, json.JSONDecodeError) as e:
         print(f"\nAviso: Falha na requisição ou processamento da resposta da OSRM: {e}")
         return None
 
 
 # ---------- Pipeline principal ----------
+class ZeroDistanceError(RuntimeError):
+    """Excesso de respostas consecutivas com distância zero da OSRM."""
+
+
+def add_route_columns(df: pd.DataFrame, route_infos: List[Optional[Dict]]):
+    """Atribui de uma vez as colunas de rota a partir da lista `route_infos` (alinhada a df)."""
+    infos = [r or {} for r in route_infos]
+    distances = [r.get("distance_km") for r in infos]
+    durations = [r.get("duration_h") for r in infos]
+    df["dist_km_rodoviaria_salvador"] = pd.Series([round(d, 1) if d is not None else None for d in distances], dtype=float)
+    df["duracao_h_viagem"] = pd.Series([round(d, 2) if d is not None else None for d in durations], dtype=float)
+    df["origem_endereco"] = [r.get("origin_name") for r in infos]
+    df["origem_coords"] = [r.get("origin_coords") for r in infos]
+    # Usa o nome do município como fallback para o destino
+    df["destino_municipio_endereco"] = [
+        r.get("dest_name") if r.get("dest_name") not in (None, "", "N/A") else nome
+        for r, nome in zip(infos, df["municipio"])
+    ]
+    df["destino_municipio_coords"] = [r.get("dest_coords") for r in infos]
+
+
+class DistancePipeline:
+    """Geocodificação e rotas de um DataFrame de municípios, com o estado compartilhado entre as etapas.
+
+    As colunas usadas no laço ficam em arrays NumPy, indexados por posição; lat/lon e as
+    colunas de rota voltam ao df no final de process().
+    """
+
+    MAX_CONSECUTIVE_ZEROS = 10
+
+    def __init__(self, df: pd.DataFrame, origem: Tuple[float, float], cache: CacheDB):
+        self.df = df
+        self.origem = origem
+        self.cache = cache
+        self._municipios = df["municipio"].to_numpy()
+        self._keys = df["_key"].to_numpy()
+        self._lats = np.full(len(df), np.nan)
+        self._lons = np.full(len(df), np.nan)
+        self._route_infos: List[Optional[Dict]] = [None] * len(df)
+        # Chave do cache de rotas: "lat_s,lon_s->lat,lon"; a parte da origem é fixa
+        self._route_prefix = f"{origem[0]:.6f},{origem[1]:.6f}->"
+        self._consecutive_zero_distances = 0
+
+    def process(self, use_osrm: bool):
+        """Resolve o cache em bloco e roda as requisições pendentes; ver process_municipios."""
+        try:
+            # --- Geocodificação (cache) ---
+            coords = [self.cache.geocode.get(key) for key in self._keys]
+            missing = []
+            for i, c in enumerate(coords):
+                if c:
+                    self._lats[i], self._lons[i] = c
+                else:
+                    missing.append((i, self._municipios[i], self._keys[i]))
+
+            # --- Rota Rodoviária (cache) ---
+            batches = []
+            if use_osrm:
+                batches = self._route_batches(i for i, c in enumerate(coords) if c is not None)
+                self._check_zero_distances(self._route_infos)
+
+            with ThreadPoolExecutor(max_workers=CONCURRENCY_NOMINATIM) as geo_executor, \
+                    ThreadPoolExecutor(max_workers=CONCURRENCY_OSRM) as route_executor:
+                # Geocodificação dos pendentes em paralelo às rotas dos já geocodificados
+                geocoded = []
+                if missing or batches:
+                    geocoded = self._run(geo_executor, route_executor, missing, batches, "Geocodificação e rotas")
+                # Rotas dos municípios recém-geocodificados
+                if use_osrm and geocoded:
+                    self._run(geo_executor, route_executor, [], self._route_batches(geocoded), "Rotas OSRM")
+        finally:
+            self.cache.commit()
+            self.df["lat"] = self._lats
+            self.df["lon"] = self._lons
+            add_route_columns(self.df, self._route_infos)
+
+    def _check_zero_distances(self, infos: List[Optional[Dict]]):
+        for route_info in infos:
+            if route_info and route_info.get("distance_km", 0) < 0.1:
+                self._consecutive_zero_distances += 1
+            else:
+                self._consecutive_zero_distances = 0
+
+            if self._consecutive_zero_distances >= self.MAX_CONSECUTIVE_ZEROS:
+                raise ZeroDistanceError(f"Interrompido após {self.MAX_CONSECUTIVE_ZEROS} respostas de distância zero consecutivas.")
+
+    def _route_batches(self, indices) -> List[List[Tuple[int, str, Tuple[float, float]]]]:
+        """Agrupa em lotes para o /table da OSRM os índices cuja rota não está em cache."""
+        pending = []
+        for i in indices:
+            lat, lon = float(self._lats[i]), float(self._lons[i])
+            if np.isnan(lat) or np.isnan(lon):
+                continue
+            route_key = f"{self._route_prefix}{lat:.6f},{lon:.6f}"
+            if route_key in self.cache.route:
+                self._route_infos[i] = self.cache.route[route_key]
+            else:
+                pending.append((i, route_key, (lat, lon)))
+        return [pending[k:k + OSRM_TABLE_CHUNK] for k in range(0, len(pending), OSRM_TABLE_CHUNK)]
+
+    def _run(self, geo_executor: ThreadPoolExecutor, route_executor: ThreadPoolExecutor, missing, batches, desc: str) -> List[int]:
+        """Submete lotes de rota e geocodificações; processa os resultados na ordem de conclusão.
+
+        Retorna os índices geocodificados com sucesso.
+        """
+        futures = {}
+        for batch in batches:
+            fut = route_executor.submit(get_osrm_table_info, self.origem, [dest for _, _, dest in batch])
+            futures[fut] = ("route", batch)
+        for i, nome, key in missing:
+            futures[geo_executor.submit(geocode_municipio, nome)] = ("geo", (i, key))
+
+        geocoded = []
+        try:
+            for fut in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                kind, data = futures[fut]
+                if kind == "geo":
+                    i, key = data
+                    coords = fut.result()
+                    if coords:
+                        self.cache.put_geocode(key, coords)
+                        self._lats[i], self._lons[i] = coords
+                        geocoded.append(i)
+                else:
+                    infos = fut.result()
+                    for j, (i, route_key, _) in enumerate(data):
+                        self._route_infos[i] = infos[j] if infos else None
+                        # Falha da requisição inteira não é gravada no cache, para ser refeita na próxima execução
+                        if infos is not None:
+                            self.cache.put_route(route_key, self._route_infos[i])
+                    self._check_zero_distances([self._route_infos[i] for i, _, _ in data])
+        finally:
+            # Em caso de erro/interrupção, descarta o que ainda não começou
+            for fut in futures:
+                fut.cancel()
+        return geocoded
+
+
+def process_municipios(df: pd.DataFrame, origem: Tuple[float, float], cache: CacheDB, use_osrm: bool):
+    """Geocodifica os municípios fora do cache e calcula as rotas em lote, em paralelo.
+
+    Acrescenta a `df` as colunas lat, lon e as colunas de rota. Entradas em cache são
+    resolvidas em bloco; só os municípios pendentes passam pelas requisições, que rodam
+    em ThreadPoolExecutors. As rotas dos municípios já geocodificados seguem em paralelo
+    à geocodificação dos demais: o Nominatim tem um executor próprio de uma thread e a
+    OSRM outro de CONCURRENCY_OSRM threads, para que a fila de geocodificações não
+    bloqueie os lotes de rota. Resultados, DataFrame e cache são atualizados apenas na
+    thread principal. As colunas de rota são gravadas mesmo se o processamento for
+    interrompido, para depuração.
+    """
+    DistancePipeline(df, origem, cache).process(use_osrm)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Gera CSV com IDHM 2010, distância geodésica e rodoviária até Salvador para os 417 municípios da Bahia.")
     parser.add_argument("--out", default="distancias_bahia.csv", help="Caminho do CSV de saída (default: distancias_bahia.csv)")
     parser.add_argument("--resume", action="store_true", help="Se existir CSV parcial, reprocessa apenas linhas com valores ausentes.")
     parser.add_argument("--no-osrm", action="store_true", help="Pula o cálculo de distância rodoviária (apenas geodésica).")
+    parser.add_argument("--refresh-idhm", action="store_true", help="Revalida o cache de IDHM com a Wikipedia (GET condicional; só reprocessa se a página mudou).")
+    parser.add_argument("--geocode-salvador", action="store_true", help="Geocodifica Salvador no Nominatim em vez de usar o cache/SALVADOR_COORDS.")
     args = parser.parse_args()
 
-    ensure_cache_dir()
-    geocode_cache = load_json(GEOCODE_CACHE)
-    route_cache = load_json(ROUTE_CACHE)
+    cache = CacheDB()
 
     print("1) Coletando municípios e códigos IBGE (IBGE Localidades)...")
-    df = get_municipios_ibge() # municipio,codigo_ibge
+    df = get_municipios_ibge() # municipio,codigo_ibge,_key
 
     print("2) Carregando IDHM 2010 (Wikipedia)...")
-    idh_map = get_idhm_2010()
-    df["idhm_2010"] = df["municipio"].map(lambda n: idh_map.get(normalize_name(n), None))
+    idh_map = get_idhm_2010(refresh=args.refresh_idhm)
+    df["idhm_2010"] = df["_key"].map(idh_map)
 
-    print("3) Geocodificando Salvador (origem)...")
+    print("3) Obtendo coordenadas de Salvador (origem)...")
     key_salvador = normalize_name("Salvador")
-    if key_salvador in geocode_cache:
-        lat_s, lon_s = geocode_cache[key_salvador]
-    else:
+    if args.geocode_salvador:
         lat_s, lon_s = get_salvador_coords()
-        geocode_cache[key_salvador] = [lat_s, lon_s]
-        save_json(GEOCODE_CACHE, geocode_cache)
-    time.sleep(SLEEP_NOMINATIM)
+        cache.put_geocode(key_salvador, (lat_s, lon_s))
+    else:
+        lat_s, lon_s = cache.geocode.get(key_salvador) or SALVADOR_COORDS
+        if key_salvador not in cache.geocode:
+            cache.put_geocode(key_salvador, (lat_s, lon_s))
 
     print("4) Geocodificando sedes municipais e calculando distâncias...")
     
-    consecutive_zero_distances = 0
-    MAX_CONSECUTIVE_ZEROS = 10
-
-    # Listas para coletar todos os resultados
-    lats, lons, geo_kms = [], [], []
-    rod_kms, durations_h, origin_names, origin_coords, dest_names, dest_coords = [], [], [], [], [], []
-
-    it = tqdm(df.itertuples(index=False), total=len(df))
-    for row in it:
-        nome = getattr(row, "municipio")
-        key = normalize_name(nome)
-        it.set_description(f"Processando: {nome}")
-
-        # --- Geocodificação ---
-        lat, lon = geocode_cache.get(key) or (None, None)
-        if lat is None:
-            coords = geocode_municipio(nome)
-            if coords:
-                lat, lon = coords
-                geocode_cache[key] = [lat, lon]
-                save_json(GEOCODE_CACHE, geocode_cache)
-            time.sleep(SLEEP_NOMINATIM)
-        lats.append(lat)
-        lons.append(lon)
-
-        # --- Distância Geodésica ---
-        geo_kms.append(round(haversine_km(lat_s, lon_s, lat, lon), 1) if lat and lon else None)
-
-        # --- Rota Rodoviária (OSRM) ---
-        route_info = None
-        if not args.no_osrm and lat and lon:
-            route_key = f"{lat_s:.6f},{lon_s:.6f}->{lat:.6f},{lon:.6f}"
-            if route_key in route_cache:
-                route_info = route_cache[route_key]
-            else:
-                route_info = get_osrm_route_info((lat_s, lon_s), (lat, lon))
-                route_cache[route_key] = route_info
-                save_json(ROUTE_CACHE, route_cache)
-            time.sleep(SLEEP_OSRM)
-        
-        # Adiciona os resultados da rota (ou None se falhou)
-        rod_kms.append(round(route_info["distance_km"], 1) if route_info and route_info.get("distance_km") is not None else None)
-        durations_h.append(round(route_info["duration_h"], 2) if route_info and route_info.get("duration_h") is not None else None)
-        origin_names.append(route_info.get("origin_name") if route_info else None)
-        origin_coords.append(route_info.get("origin_coords") if route_info else None)
-        
-        # Usa o nome do município como fallback para o destino
-        dest_name = route_info.get("dest_name") if route_info else None
-        if not dest_name or dest_name == "N/A":
-            dest_names.append(nome)
-        else:
-            dest_names.append(dest_name)
-            
-        dest_coords.append(route_info.get("dest_coords") if route_info else None)
-
-        # --- Verificação de zeros consecutivos ---
-        if route_info and route_info.get("distance_km", 0) < 0.1:
-            consecutive_zero_distances += 1
-        else:
-            consecutive_zero_distances = 0
-
-        if consecutive_zero_distances >= MAX_CONSECUTIVE_ZEROS:
-            it.close()
-            print(f"\nERRO CRÍTICO: Interrompido após {MAX_CONSECUTIVE_ZEROS} respostas de distância zero consecutivas.")
-            # Atribui dados parciais antes de sair para permitir a depuração
-            df["dist_km_rodoviaria_salvador"] = rod_kms
-            out_path_parcial = args.out.replace(".csv", "_parcial_erro.csv")
-            df.to_csv(out_path_parcial, index=False, encoding="utf-8")
-            exit(1)
-
-    # Atribui todas as listas de resultados ao DataFrame
-    df["dist_km_geodesica_salvador"] = geo_kms
-    df["dist_km_rodoviaria_salvador"] = rod_kms
-    df["duracao_h_viagem"] = durations_h
-    df["origem_endereco"] = origin_names
-    df["origem_coords"] = origin_coords
-    df["destino_municipio_endereco"] = dest_names
-    df["destino_municipio_coords"] = dest_coords
-
-    # Seleciona e ordena colunas finais para o CSV
-    df_out = df[[
+    try:
+        process_municipios(df, (lat_s, lon_s), cache, not args.no_osrm)
+    except ZeroDistanceError as e:
+        print(f"\nERRO CRÍTICO: {e}")
+        # Grava dados parciais antes de sair para permitir a depuração
+        out_path_parcial = args.out.replace(".csv", "_parcial_erro.csv")
+        df.to_csv(out_path_parcial, index=False, encoding="utf-8")
+        exit(1)
+    finally:
+        cache.close()
+
+    # --- Distância Geodésica (vetorizada para todos os municípios) ---
+    geo_kms = haversine_km(lat_s, lon_s, df["lat"].to_numpy(), df["lon"].to_numpy())
+    df["dist_km_geodesica_salvador"] = np.round(geo_kms, 1)
+
+    # Colunas finais do CSV, na ordem de saída (o df já está ordenado por get_municipios_ibge)
+    out_cols = [
         "municipio", "codigo_ibge", "idhm_2010",
         "dist_km_geodesica_salvador", "dist_km_rodoviaria_salvador", "duracao_h_viagem",
         "origem_endereco", "origem_coords",
         "destino_municipio_endereco", "destino_municipio_coords"
-    ]]
+    ]
 
-    # Exporta
+    # Exporta em uma única escrita, sem copiar as colunas para um DataFrame intermediário
     out_path = args.out
-    df_out.to_csv(out_path, index=False, encoding="utf-8")
+    df.to_csv(out_path, columns=out_cols, index=False, encoding="utf-8", lineterminator="\n")
     print(f"\nConcluído! CSV gerado em: {out_path}")
 
 
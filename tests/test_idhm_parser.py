@@ -0,0 +1,60 @@
+import re
+import sys
+import unittest
+from io import StringIO
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from ba_417_idh_distancias import normalize_name, parse_idhm_html  # noqa: E402
+
+FIXTURE = Path(__file__).parent / "fixtures" / "idhm_rowspan_colspan.html"
+
+
+def parse_idhm_read_html(html: str) -> dict:
+    """Extração original do script, via pd.read_html (referência para o parser lxml)."""
+    idh_map = {}
+    for tbl in pd.read_html(StringIO(html)):
+        cols = [normalize_name(str(c)) for c in tbl.columns]
+        if not (any("munic" in c for c in cols) and any("idh" in c for c in cols)):
+            continue
+        col_mun = next(c for c in tbl.columns if "munic" in normalize_name(str(c)))
+        col_idh = next(c for c in tbl.columns if "idh" in normalize_name(str(c)))
+        for _, row in tbl[[col_mun, col_idh]].dropna().iterrows():
+            nome = re.sub(r"\[.*?\]", "", str(row[col_mun])).strip()
+            idh_txt = str(row[col_idh]).strip().replace(",", ".")
+            try:
+                idh_val = float(re.sub(r"[^\d\.]", "", idh_txt))
+            except Exception:
+                continue
+            idh_map[normalize_name(nome)] = idh_val
+    return idh_map
+
+
+class ParseIdhmHtmlTest(unittest.TestCase):
+    def test_matches_read_html(self):
+        content = FIXTURE.read_bytes()
+        self.assertEqual(parse_idhm_html(content), parse_idhm_read_html(content.decode("utf-8")))
+
+    def test_rowspan_and_colspan(self):
+        idh_map = parse_idhm_html(FIXTURE.read_bytes())
+        self.assertEqual(idh_map["salvador"], 0.759)
+        # Posição empatada (rowspan) não desloca as colunas da linha seguinte
+        self.assertEqual(idh_map["feira de santana"], 0.712)
+        self.assertEqual(idh_map["itabuna"], 0.712)
+        self.assertEqual(idh_map["madre de deus"], 0.708)
+        self.assertNotIn("xique-xique", idh_map)
+
+    def test_decimal_comma(self):
+        content = FIXTURE.read_bytes().replace(b"0.759", b"0,759")
+        self.assertEqual(parse_idhm_html(content)["salvador"], 0.759)
+
+    def test_no_table(self):
+        with self.assertRaises(RuntimeError):
+            parse_idhm_html(b"<html><body><p>sem tabela</p></body></html>")
+
+
+if __name__ == "__main__":
+    unittest.main()